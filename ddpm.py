@@ -711,22 +711,18 @@ def normalized_cross_correlation(x, y, return_map, reduction="mean", eps=1e-8):
     x = x - x_mean
     y = y - y_mean
 
-    dev_xy = torch.mul(x, y)
-    dev_xx = torch.mul(x, x)
-    dev_yy = torch.mul(y, y)
+    # reduced products, the full size products are never materialized
+    dev_xy_sum = torch.einsum("bn,bn->b", x, y).unsqueeze(1)
+    dev_xx_sum = torch.einsum("bn,bn->b", x, x).unsqueeze(1)
+    dev_yy_sum = torch.einsum("bn,bn->b", y, y).unsqueeze(1)
+    denominator = torch.sqrt(torch.mul(dev_xx_sum, dev_yy_sum)) + eps
 
-    dev_xx_sum = torch.sum(dev_xx, dim=1, keepdim=True)
-    dev_yy_sum = torch.sum(dev_yy, dim=1, keepdim=True)
-
-    ncc = torch.div(
-        dev_xy + eps / dev_xy.shape[1],
-        torch.sqrt(torch.mul(dev_xx_sum, dev_yy_sum)) + eps,
-    )
-    ncc_map = ncc.view(b, *shape[1:])
+    # the correlation map summed over its elements, `sum(dev_xy + eps / n) == dev_xy_sum + eps`
+    ncc = torch.div(dev_xy_sum + eps, denominator)
 
     # reduce
     if reduction == "mean":
-        ncc = torch.mean(torch.sum(ncc, dim=1))
+        ncc = torch.mean(ncc)
     elif reduction == "sum":
         ncc = torch.sum(ncc)
     else:
@@ -735,15 +731,17 @@ def normalized_cross_correlation(x, y, return_map, reduction="mean", eps=1e-8):
     if not return_map:
         return ncc
 
-    return ncc, ncc_map
+    ncc_map = torch.div(torch.mul(x, y) + eps / x.shape[1], denominator)
+    return ncc, ncc_map.view(b, *shape[1:])
 
 def ncc_loss(predicted_noise, noise, reduction="mean"):
     '''
-    Both the return outputs of the normalized_cross_correlation function are of type torch.Tensor(), so no type conversion required
+    The output of the normalized_cross_correlation function is of type torch.Tensor(), so no type conversion required.
+    The correlation map is not used by the loss, so it is not computed.
     '''
-    ncc_val, _ = normalized_cross_correlation(
-        predicted_noise, noise, return_map=True, reduction=reduction
-    ) 
+    ncc_val = normalized_cross_correlation(
+        predicted_noise, noise, return_map=False, reduction=reduction
+    )
     
     return ncc_val
 
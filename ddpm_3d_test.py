@@ -1,17 +1,19 @@
 # Using torch.nn.DataParallel
 
 import copy
+import functools
 import math
 import os
 import logging
 import pathlib
 from typing import Tuple
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
+import torchvision.io
 import torchvision.utils
-from PIL import Image
 from torch.cuda.amp import GradScaler
 from torch.utils.data import Dataset, DataLoader
 from torchvision.transforms import transforms
@@ -27,6 +29,27 @@ logging.basicConfig(
     datefmt="%I:%M:%S",
 )
 
+# TF32 tensor cores for float32 matmuls and convolutions, cuDNN autotuning for the fixed Conv3d shapes.
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+
+@torch.jit.script
+def ddpm_step(
+    x: torch.Tensor,
+    eps: torch.Tensor,
+    inv_sqrt_alpha: float,
+    noise_scale: float,
+    epsilon: float,
+    noise: torch.Tensor,
+) -> torch.Tensor:
+    """Algorithm 2 update, `x = (x - noise_scale * eps) * inv_sqrt_alpha + epsilon * noise`, done in place on `x`
+    so a single buffer is read and written instead of allocating every intermediate term.
+    """
+    return x.sub_(eps, alpha=noise_scale).mul_(inv_sqrt_alpha).add_(noise, alpha=epsilon)
+
 
 class Diffusion:
     def __init__(
@@ -35,8 +58,10 @@ class Diffusion:
         noise_steps: int = 1000,
         beta_start: float = 1e-4,
         beta_end: float = 0.02,
+        use_cuda_graph: bool = False,
     ):
         self.device = device
+        self.use_cuda_graph = use_cuda_graph
         self.noise_steps = noise_steps
         self.beta_start = beta_start
         self.beta_end = beta_end
@@ -59,6 +84,18 @@ class Diffusion:
         del self.alpha
         del self.alpha_hat
 
+        # Store schedules broadcastable over [batch, channels, frames, height, width], so values gathered for
+        # a batch of timesteps need no reshape.
+        self.beta = self.beta.view(-1, 1, 1, 1, 1)
+        self.sqrt_alpha_hat = self.sqrt_alpha_hat.view(-1, 1, 1, 1, 1)
+        self.sqrt_one_minus_alpha_hat = self.sqrt_one_minus_alpha_hat.view(-1, 1, 1, 1, 1)
+        self.sqrt_alpha = self.sqrt_alpha.view(-1, 1, 1, 1, 1)
+        self.std_beta = self.std_beta.view(-1, 1, 1, 1, 1)
+
+        # Reused across training steps by `q_sample` and `sample_timesteps`, reallocated only when the batch changes.
+        self._noise_buf = None
+        self._t_buf = None
+
     def linear_noise_schedule(self) -> torch.Tensor:
         """Same amount of noise is applied each step. Weakness is near end steps image is so noisy it is hard make
         out information. So noise removal is also very small amount, so it takes more steps to generate clear image.
@@ -89,16 +126,25 @@ class Diffusion:
         Found in section 2. `q` gradually adds gaussian noise according to variance schedule. Also,
         can be seen on figure 2.
         """
-        sqrt_alpha_hat = self.sqrt_alpha_hat[t].view(-1, 1, 1, 1, 1)
-        sqrt_one_minus_alpha_hat = self.sqrt_one_minus_alpha_hat[t].view(-1, 1, 1, 1, 1)
-        epsilon = torch.randn_like(x, device=self.device)
+        # Schedules stay float32, gathered values are cast to the input precision so the update runs in it.
+        sqrt_alpha_hat = self.sqrt_alpha_hat.index_select(0, t).to(x.dtype)
+        sqrt_one_minus_alpha_hat = self.sqrt_one_minus_alpha_hat.index_select(0, t).to(
+            x.dtype
+        )
+        if (
+            self._noise_buf is None
+            or self._noise_buf.shape != x.shape
+            or self._noise_buf.dtype != x.dtype
+        ):
+            self._noise_buf = torch.empty_like(x)
+        epsilon = self._noise_buf.normal_()
         return sqrt_alpha_hat * x + sqrt_one_minus_alpha_hat * epsilon, epsilon
 
     def sample_timesteps(self, batch_size: int) -> torch.Tensor:
         """Random timestep for each sample in a batch. Timesteps selected from [1, noise_steps]."""
-        return torch.randint(
-            low=1, high=self.noise_steps, size=(batch_size,), device=self.device
-        )
+        if self._t_buf is None or self._t_buf.shape[0] != batch_size:
+            self._t_buf = torch.empty(batch_size, dtype=torch.long, device=self.device)
+        return self._t_buf.random_(1, self.noise_steps)
 
     def p_sample(
         self, eps_model: nn.Module, n: int, scale_factor: int = 2
@@ -123,25 +169,38 @@ class Diffusion:
         logging.info(f"Sampling {n} images....")
 
         eps_model.eval()
-        with torch.no_grad():
-            x = torch.randn((n, 3, 8, 40, 40 ), device=self.device)
-
-            for i in tqdm(reversed(range(1, self.noise_steps)), position=0):
-                t = torch.ones(n, dtype=torch.long, device=self.device) * i
-
-                sqrt_alpha_t = self.sqrt_alpha[t].view(-1, 1, 1, 1, 1)
-                beta_t = self.beta[t].view(-1, 1, 1, 1, 1)
-                sqrt_one_minus_alpha_hat_t = self.sqrt_one_minus_alpha_hat[t].view(
-                    -1, 1, 1, 1, 1
-                )
-                epsilon_t = self.std_beta[t].view(-1, 1, 1, 1, 1)
-
-                random_noise = torch.randn_like(x) if i > 1 else torch.zeros_like(x)
+        # Pure inference, also skips the version counter and view tracking that `no_grad` still does.
+        with torch.inference_mode():
+            x = torch.randn((n, 3, 8, 40, 40), device=self.device).to(
+                memory_format=torch.channels_last_3d
+            )
 
-                x = (
-                    (1 / sqrt_alpha_t)
-                    * (x - ((beta_t / sqrt_one_minus_alpha_hat_t) * eps_model(x, t)))
-                ) + (epsilon_t * random_noise)
+            if self.use_cuda_graph:
+                x = self._denoise_cuda_graph(eps_model=eps_model, x=x)
+            else:
+                # Step coefficients for every timestep, copied to the host once instead of gathered per step.
+                inv_sqrt_alpha = (1 / self.sqrt_alpha).flatten().tolist()
+                noise_scale = (self.beta / self.sqrt_one_minus_alpha_hat).flatten().tolist()
+                epsilon = self.std_beta.flatten().tolist()
+                t = torch.empty(n, dtype=torch.long, device=self.device)
+                random_noise = torch.empty_like(x)
+
+                for i in tqdm(reversed(range(1, self.noise_steps)), position=0):
+                    t.fill_(i)
+
+                    if i > 1:
+                        random_noise.normal_()
+                    else:
+                        random_noise.zero_()
+
+                    x = ddpm_step(
+                        x,
+                        eps_model(x, t),
+                        inv_sqrt_alpha=inv_sqrt_alpha[i],
+                        noise_scale=noise_scale[i],
+                        epsilon=epsilon[i],
+                        noise=random_noise,
+                    )
 
         eps_model.train()
 
@@ -149,6 +208,57 @@ class Diffusion:
         x = F.interpolate(input=x, scale_factor=scale_factor, mode="nearest-exact")
         return x
 
+    def _denoise_cuda_graph(self, eps_model: nn.Module, x: torch.Tensor) -> torch.Tensor:
+        """Same denoising loop as `p_sample`, but one step is captured in a CUDA graph and replayed per timestep.
+
+        Shapes stay fixed over the whole loop, so only the timestep, the step coefficients and the random noise
+        change. Those are copied into static buffers before each replay, which removes the python dispatch and
+        kernel launch overhead of running the model eagerly for every step.
+        """
+        # Per timestep 1 / sqrt(alpha), beta / sqrt(1 - alpha_hat) and sqrt(beta), each broadcastable over x.
+        step_coefficients = torch.stack(
+            [1 / self.sqrt_alpha, self.beta / self.sqrt_one_minus_alpha_hat, self.std_beta], dim=1
+        )
+
+        x_static = x.clone()
+        t_static = torch.full(
+            (x.shape[0],), self.noise_steps - 1, dtype=torch.long, device=self.device
+        )
+        coefficients_static = step_coefficients[-1].clone()
+        noise_static = torch.zeros_like(x)
+
+        def denoise_step() -> None:
+            inv_sqrt_alpha_t, noise_scale_t, epsilon_t = coefficients_static
+            x_static.copy_(
+                inv_sqrt_alpha_t * (x_static - noise_scale_t * eps_model(x_static, t_static))
+                + epsilon_t * noise_static
+            )
+
+        # Warm up on a side stream before capturing, as `torch.cuda.graph` requires.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                denoise_step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            denoise_step()
+
+        # Warm up ran real steps on the buffer, start again from the initial noise.
+        x_static.copy_(x)
+        for i in tqdm(reversed(range(1, self.noise_steps)), position=0):
+            t_static.fill_(i)
+            coefficients_static.copy_(step_coefficients[i])
+            if i > 1:
+                noise_static.normal_()
+            else:
+                noise_static.zero_()
+            graph.replay()
+
+        return x_static
+
 
 
 class PositionalEncoding(nn.Module):
@@ -176,6 +286,15 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         self.apply_dropout = apply_dropout
 
+        pos_encoding = self.sinusoidal_table(max_len=max_len, embedding_dim=embedding_dim).clone()
+        self.register_buffer(name="pos_encoding", tensor=pos_encoding, persistent=False)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def sinusoidal_table(max_len: int, embedding_dim: int) -> torch.Tensor:
+        """Table of `[max_len, embedding_dim]` embeddings on cpu. Cached, so models of the same size share the
+        sin, cos computation. Callers must clone it before moving or modifying.
+        """
         pos_encoding = torch.zeros(max_len, embedding_dim)
         position = torch.arange(start=0, end=max_len).unsqueeze(1)
         div_term = torch.exp(
@@ -186,14 +305,14 @@ class PositionalEncoding(nn.Module):
 
         pos_encoding[:, 0::2] = torch.sin(position * div_term)
         pos_encoding[:, 1::2] = torch.cos(position * div_term)
-        self.register_buffer(name="pos_encoding", tensor=pos_encoding, persistent=False)
+        return pos_encoding
 
     def forward(self, t: torch.LongTensor) -> torch.Tensor:
         """Get precalculated positional embedding at timestep t. Outputs same as video implementation
         code but embeddings are in [sin, cos, sin, cos] format instead of [sin, sin, cos, cos] in that code.
         Also batch dimension is added to final output.
         """
-        positional_encoding = self.pos_encoding[t].squeeze(1)
+        positional_encoding = self.pos_encoding[t]
         if self.apply_dropout:
             return self.dropout(positional_encoding)
         return positional_encoding
@@ -426,16 +545,18 @@ class EMA:
         self.beta = beta
         self.step = 0
 
+    @torch.no_grad()
     def update_model_average(
         self, ema_model: nn.Module, current_model: nn.Module
     ) -> None:
-        for current_params, ema_params in zip(
-            current_model.parameters(), ema_model.parameters()
-        ):
-            old_weights, new_weights = ema_params.data, current_params.data
-            ema_params.data = self.update_average(
-                old_weights=old_weights, new_weights=new_weights
-            )
+        """Same as `update_average` for every parameter, `ema * beta + (1 - beta) * current` is a lerp from ema
+        towards current by `1 - beta`. Done as a single multi tensor kernel instead of a python loop of small ops.
+        """
+        torch._foreach_lerp_(
+            list(ema_model.parameters()),
+            list(current_model.parameters()),
+            1 - self.beta,
+        )
 
     def update_average(
         self, old_weights: torch.Tensor, new_weights: torch.Tensor
@@ -470,6 +591,7 @@ class Tester:
         self.batch_size = batch_size
         self.image_size = image_size
 
+    @torch.inference_mode()
     def test_unet(self) -> None:
         net = UNet().to(self.device)
         print(f"Param count: {sum([p.numel() for p in net.parameters()])}")
@@ -483,6 +605,7 @@ class Tester:
         print(f"UNet input shape: {x.shape}")
         print(f"UNet output shape: {output.shape}")
 
+    @torch.inference_mode()
     def test_attention(self) -> None:
         x = torch.randn(size=(4, 128, 32, 32))
         sa1 = TransformerEncoderSA(128, 32)
@@ -493,6 +616,7 @@ class Tester:
         print(f"Self attention input shape: {x.shape}")
         print(f"Self attention output shape: {output.shape}")
 
+    @torch.inference_mode()
     def test_jit(self) -> None:
         net = torch.jit.script(UNet().to(self.device))
         print(f"Param count: {sum([p.numel() for p in net.parameters()])}")
@@ -508,24 +632,20 @@ class Tester:
 
 
 class Utils:
+    # Checkpoints are written on a background thread, `torch.save` releases the GIL while writing tensor data.
+    _checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+
     def __init__(self):
         super(Utils, self).__init__()
 
-    @staticmethod
-    def collate_fn(batch):
-        """Discard none samples."""
-        batch = list(filter(lambda x: x is not None, batch))
-        return torch.utils.data.dataloader.default_collate(batch)
-
     @staticmethod
     def save_images(videos: torch.Tensor, save_path: str) -> None:
         pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
         for i in range(8):
             images = videos[:, :, i, :, :]
+            # Encodes the uint8 grid directly with libjpeg, no numpy and PIL round trip.
             grid = torchvision.utils.make_grid(images)
-            img_arr = grid.permute(1, 2, 0).cpu().numpy()
-            img = Image.fromarray(img_arr)
-            img.save(os.path.join(save_path, f"frame_{i}.jpg"))
+            torchvision.io.write_jpeg(grid.cpu(), os.path.join(save_path, f"frame_{i}.jpg"))
 
     @staticmethod
     def save_checkpoint(
@@ -536,6 +656,8 @@ class Utils:
         scheduler: optim.lr_scheduler = None,
         grad_scaler: GradScaler = None,
     ) -> None:
+        # Unwrap `torch.compile` models, otherwise every key is saved with an `_orig_mod.` prefix.
+        model = getattr(model, "_orig_mod", model)
         checkpoint = {
             "epoch": epoch,
             "state_dict": model.state_dict(),
@@ -544,10 +666,35 @@ class Utils:
             checkpoint["optimizer"] = optimizer.state_dict()
         if scheduler:
             checkpoint["scheduler"] = scheduler.state_dict()
-        if scheduler:
+        # A disabled scaler, as with bfloat16 autocast, has an empty state that an enabled one refuses to load.
+        if grad_scaler is not None and grad_scaler.is_enabled():
             checkpoint["grad_scaler"] = grad_scaler.state_dict()
 
-        torch.save(checkpoint, filename)
+        # Snapshot on the host so training can keep updating the weights while the file is written.
+        checkpoint = Utils._to_cpu(checkpoint)
+        Utils._checkpoint_executor.submit(Utils._write_checkpoint, checkpoint, filename)
+
+    @staticmethod
+    def _to_cpu(state):
+        """Copies every tensor of a nested state dict to the host."""
+        if isinstance(state, torch.Tensor):
+            return state.detach().to("cpu", copy=True)
+        if isinstance(state, dict):
+            return {key: Utils._to_cpu(value) for key, value in state.items()}
+        if isinstance(state, (list, tuple)):
+            return type(state)(Utils._to_cpu(value) for value in state)
+        return state
+
+    @staticmethod
+    def _write_checkpoint(checkpoint: dict, filename: str) -> None:
+        # Saved to a temporary file and renamed, so an interrupted save never leaves a truncated checkpoint.
+        tmp_filename = f"{filename}.tmp"
+        try:
+            torch.save(checkpoint, tmp_filename)
+            os.replace(tmp_filename, filename)
+        except Exception:
+            logging.exception(f"=> Saving checkpoint {filename} failed.")
+            return
         logging.info("=> Saving checkpoint complete.")
 
     @staticmethod
@@ -562,10 +709,16 @@ class Utils:
         checkpoint = torch.load(filename, map_location="cuda")
         model.load_state_dict(checkpoint["state_dict"], strict=False)
         if "optimizer" in checkpoint:
+            # The saved param groups replace the constructed ones, keep this run's fused kernel choice instead of
+            # the checkpoint's, which is unset for checkpoints written before the switch to fused AdamW.
+            fused = [group["fused"] for group in optimizer.param_groups]
             optimizer.load_state_dict(checkpoint["optimizer"])
+            for group, group_fused in zip(optimizer.param_groups, fused):
+                group["fused"] = group_fused
         if "scheduler" in checkpoint:
             scheduler.load_state_dict(checkpoint["scheduler"])
-        if "grad_scaler" in checkpoint:
+        # Checkpoints of runs with a disabled scaler may hold its empty state, nothing to restore then.
+        if checkpoint.get("grad_scaler"):
             grad_scaler.load_state_dict(checkpoint["grad_scaler"])
         return checkpoint["epoch"]
 
@@ -581,18 +734,27 @@ class Trainer:
         batch_size: int = 1,
         accumulation_iters: int = 64,
         sample_count: int = 1,
-        num_workers: int = 0,
+        num_workers: int = None,
         device: str = "cuda",
         num_epochs: int = 1000,
-        fp16: bool = False,
+        fp16: bool = True,
         save_every: int = 2000,
         learning_rate: float = 1e-5,
         noise_steps: int = 500,
         enable_train_mode: bool = True,
+        compile_model: bool = False,
+        cuda_graph_sampling: bool = False,
     ):
         self.num_epochs = num_epochs
         self.device = device
         self.fp16 = fp16
+        # bfloat16 keeps the float32 exponent range and trains without loss scaling, prefer it from Ampere on.
+        # Older GPUs only emulate it without tensor cores, they stay on float16 with the loss scaler.
+        self.amp_dtype = (
+            torch.bfloat16
+            if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+            else torch.float16
+        )
         self.save_every = save_every
         self.accumulation_iters = accumulation_iters
         self.sample_count = sample_count
@@ -606,6 +768,13 @@ class Trainer:
             diffusion_dataset = CustomVideoDataset(
                 npy_path=dataset_path,
             )
+            if num_workers is None:
+                num_workers = max(4, os.cpu_count() // 2)
+            # Keep workers alive across epochs and a few batches ahead of the GPU. Both options are only
+            # valid with worker processes.
+            worker_kwargs = (
+                dict(persistent_workers=True, prefetch_factor=4) if num_workers > 0 else {}
+            )
             self.train_loader = DataLoader(
                 diffusion_dataset,
                 batch_size=batch_size,
@@ -613,21 +782,30 @@ class Trainer:
                 pin_memory=True,
                 num_workers=num_workers,
                 drop_last=False,
-                collate_fn=Utils.collate_fn,
+                **worker_kwargs,
             )
 
-        self.unet_model = UNet().to(device)
+        # NDHWC layout lets cuDNN run its tensor core Conv3d kernels without transposing. The EMA copy
+        # below inherits it.
+        self.unet_model = UNet().to(device, memory_format=torch.channels_last_3d)
         self.diffusion = Diffusion(
-            device=self.device, noise_steps=noise_steps
+            device=self.device,
+            noise_steps=noise_steps,
+            # `reduce-overhead` compilation already replays CUDA graphs.
+            use_cuda_graph=cuda_graph_sampling and not compile_model,
         )
-        self.optimizer = optim.Adam(
+        self.optimizer = optim.AdamW(
             params=self.unet_model.parameters(),
             lr=learning_rate,  # betas=(0.9, 0.999)
+            weight_decay=0.0,
+            fused=torch.device(device).type == "cuda",
         )
         self.scheduler = optim.lr_scheduler.CosineAnnealingLR(
             optimizer=self.optimizer, T_max=300
         )
-        self.grad_scaler = GradScaler()
+        self.grad_scaler = GradScaler(
+            enabled=self.fp16 and self.amp_dtype == torch.float16
+        )
 
         self.ema = EMA(beta=0.95)
         self.ema_model = copy.deepcopy(self.unet_model).eval().requires_grad_(False)
@@ -649,6 +827,11 @@ class Trainer:
                 filename=checkpoint_path_ema,
             )
 
+        if compile_model:
+            # Compiled after loading weights so checkpoints keep the plain module parameter names.
+            self.unet_model = torch.compile(self.unet_model, mode="reduce-overhead")
+            self.ema_model = torch.compile(self.ema_model, mode="reduce-overhead")
+
     def sample(
         self,
         epoch: int = None,
@@ -687,23 +870,34 @@ class Trainer:
                 f"Epoch: {epoch}", file=sys.stderr
             )  # printing into the err.log file rather than the out.log
             total_loss = 0.0
-            accumulated_minibatch_loss = 0.0
+            # Accumulated on the device, read back once per optimizer step instead of syncing every minibatch.
+            accumulated_minibatch_loss = torch.zeros((), device=self.device)
 
             with tqdm(self.train_loader) as pbar:
                 for batch_idx, batch_data in enumerate(pbar):
-                    real_images = batch_data.to(self.device)
+                    # uint8 pixels in [0, 255] to [-1, 1].
+                    real_images = (
+                        batch_data.to(
+                            self.device,
+                            non_blocking=True,
+                            memory_format=torch.channels_last_3d,
+                        )
+                        .float()
+                        .mul_(1 / 127.5)
+                        .sub_(1.0)
+                    )
                     current_batch_size = real_images.shape[0]
                     t = self.diffusion.sample_timesteps(batch_size=current_batch_size)
                     x_t, noise = self.diffusion.q_sample(x=real_images, t=t)
 
                     with torch.autocast(
-                        device_type=self.device, dtype=torch.float16, enabled=self.fp16
+                        device_type=self.device, dtype=self.amp_dtype, enabled=self.fp16
                     ):
                         predicted_noise = self.unet_model(x=x_t, t=t)
 
                         loss = F.smooth_l1_loss(predicted_noise, noise)
                         loss /= self.accumulation_iters
-                        accumulated_minibatch_loss += float(loss)
+                        accumulated_minibatch_loss.add_(loss.detach())
 
                     self.grad_scaler.scale(loss).backward()
 
@@ -715,15 +909,16 @@ class Trainer:
                             ema_model=self.ema_model, model=self.unet_model
                         )
                         
+                        minibatch_loss = accumulated_minibatch_loss.item()
                         total_loss += (
-                            float(accumulated_minibatch_loss)
+                            minibatch_loss
                             / len(self.train_loader)
                             * self.accumulation_iters
                         )
                         pbar.set_description(
-                            f"Loss minibatch: {float(accumulated_minibatch_loss):.4f}, total: {total_loss:.4f}"
+                            f"Loss minibatch: {minibatch_loss:.4f}, total: {total_loss:.4f}"
                         )
-                        accumulated_minibatch_loss = 0.0
+                        accumulated_minibatch_loss.zero_()
 
                     if not batch_idx % self.save_every:
                         self.sample(
@@ -1,23 +1,142 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
 import h5py
-import cv2
 import numpy as np
-import os
-import torch
-from torch.utils.data import Dataset
-from torchvision import transforms
-from PIL import Image
-from typing import Tuple
-
-hf = h5py.File("/mnt/MIG_Store/Datasets/faceforensicspp/Originalface.hdf5", "r")
-temp_videos = [] 
-for temp in range(1000):
-    video_no = '{:03}'.format(temp)
-    frames = list(hf[f"Original/{video_no}"].keys())
-    temp_list = []
-    for frame in frames:
-        temp_list.append(hf[f"Original/{video_no}/{frame}"][()])
-        if(len(temp_list) == 108):
-            break
-    temp_videos.append(np.array(temp_list))
-videos = np.array(temp_videos)
-np.save("./data_108.npy", videos)
\ No newline at end of file
+
+try:
+    # Registers the Blosc2 filter `repack_hdf5.py` compresses with when it is installed.
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+HDF5_PATH = "/mnt/MIG_Store/Datasets/faceforensicspp/Originalface.hdf5"
+# One `Original/<video>/frames` dataset per video, see `build_frames_file`.
+FRAMES_PATH = "./Originalface_frames.hdf5"
+# Same layout as `FRAMES_PATH` with real, chunked datasets, written by `repack_hdf5.py`.
+REPACKED_PATH = "./Originalface_repacked.hdf5"
+OUTPUT_PATH = "./data_108.npy"
+NUM_VIDEOS = 1000
+NUM_FRAMES = 108
+NUM_WORKERS = 8
+# Stored in the `frame_order` attribute of the frames and repacked files. Files written before frames were
+# ordered by frame number lack it and are rebuilt instead of reused.
+FRAME_ORDER = "numeric"
+
+# Frames file and output memory map, opened once per worker process by `_open_worker_files`.
+_worker_file = None
+_worker_videos = None
+
+
+def frame_names(video: h5py.Group) -> list:
+    """Names of the first `NUM_FRAMES` frame datasets of a video group, in frame number order.
+
+    HDF5 orders links by name, which puts `frame_10` before `frame_9`. Every name is collected in one pass over
+    the links and sorted by the frame number it contains before slicing.
+    """
+    names = []
+    # `list.append` returns None, which keeps the iteration going.
+    video.id.links.iterate(names.append)
+    if len(names) < NUM_FRAMES:
+        raise ValueError(f"Video {video.name} has {len(names)} frames, {NUM_FRAMES} needed.")
+    names.sort(key=lambda name: int(re.search(rb"\d+", name).group()))
+    return [name.decode() for name in names[:NUM_FRAMES]]
+
+
+def build_frames_file(source_path: str, frames_path: str) -> None:
+    """Writes a file with a virtual `Original/<video>/frames` dataset of shape `[NUM_FRAMES, *frame_shape]` per
+    video, mapped onto the per frame datasets of the source file.
+
+    Built once, afterwards a whole video is read with one hyperslab read instead of `NUM_FRAMES` dataset lookups
+    and reads from python. The source file is only referenced, no frame data is copied.
+    """
+    # Written under a temporary name, an interrupted build never leaves a file that cannot be opened behind.
+    tmp_path = f"{frames_path}.tmp"
+    with h5py.File(source_path, "r") as src, h5py.File(tmp_path, "w") as out:
+        for video_idx in range(NUM_VIDEOS):
+            video = src[f"Original/{video_idx:03}"]
+            names = frame_names(video)
+            first_frame = video[names[0]]
+
+            layout = h5py.VirtualLayout(
+                shape=(NUM_FRAMES, *first_frame.shape), dtype=first_frame.dtype
+            )
+            for frame_idx, name in enumerate(names):
+                # HDF5 would fill, crop or convert a mismatched frame at read time instead of failing.
+                frame = video[name]
+                if frame.shape != first_frame.shape or frame.dtype != first_frame.dtype:
+                    raise ValueError(
+                        f"Frame {video.name}/{name} is {frame.shape} {frame.dtype}, "
+                        f"expected {first_frame.shape} {first_frame.dtype} like {names[0]}."
+                    )
+                layout[frame_idx] = h5py.VirtualSource(
+                    source_path, f"{video.name}/{name}", shape=first_frame.shape
+                )
+            out.create_virtual_dataset(f"{video.name}/frames", layout)
+        out.attrs["frame_order"] = FRAME_ORDER
+    os.replace(tmp_path, frames_path)
+
+
+def has_current_frame_order(path: str) -> bool:
+    """Whether `path` exists and was written with the current `FRAME_ORDER`."""
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, "r") as hf:
+        return hf.attrs.get("frame_order") == FRAME_ORDER
+
+
+def _open_worker_files(frames_path: str, output_path: str) -> None:
+    global _worker_file, _worker_videos
+    # Default chunk cache on purpose, every clip is one read covering whole chunks, so no chunk is ever read twice.
+    _worker_file = h5py.File(frames_path, "r")
+    _worker_videos = np.load(output_path, mmap_mode="r+")
+
+
+def _read_video(video_idx: int) -> None:
+    # Workers write disjoint videos of the shared mapping, no locking needed.
+    _worker_file[f"Original/{video_idx:03}/frames"].read_direct(_worker_videos[video_idx])
+    # Written back before the task completes, `extract_videos` returning means every video is on disk.
+    _worker_videos.flush()
+
+
+def extract_videos(
+    frames_path: str, output_path: str, num_workers: int = NUM_WORKERS
+) -> None:
+    """Writes the frames of every video into a `[videos, frames, *frame_shape]` `.npy` file.
+
+    The output is created up front as a memory mapped `.npy` from the shape and dtype of the first video and every
+    video is read straight into its slot of the file. Nothing is held in memory or serialized a second time at the
+    end, each worker flushes its mapping after every video it reads. Videos are read in parallel by worker
+    processes with their own file handle, h5py serializes all calls within a process behind a single lock so
+    threads would not overlap the reads.
+    """
+    with h5py.File(frames_path, "r") as hf:
+        first_video = hf["Original/000/frames"]
+        # Pixels stay uint8 on disk, the trainers normalize to float on the GPU.
+        if first_video.dtype != np.uint8:
+            raise TypeError(f"Expected uint8 frames, got {first_video.dtype}.")
+        # Only writes the header and sizes the file, the workers fill it through their own mappings.
+        np.lib.format.open_memmap(
+            output_path,
+            mode="w+",
+            dtype=first_video.dtype,
+            shape=(NUM_VIDEOS, *first_video.shape),
+        )
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_open_worker_files,
+        initargs=(frames_path, output_path),
+    ) as executor:
+        for _ in executor.map(_read_video, range(NUM_VIDEOS)):
+            pass
+
+
+if __name__ == "__main__":
+    if not has_current_frame_order(FRAMES_PATH):
+        build_frames_file(source_path=HDF5_PATH, frames_path=FRAMES_PATH)
+    extract_videos(
+        frames_path=REPACKED_PATH if has_current_frame_order(REPACKED_PATH) else FRAMES_PATH,
+        output_path=OUTPUT_PATH,
+    )
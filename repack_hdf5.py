@@ -0,0 +1,143 @@
+"""Repacks the per video frames into real datasets chunked for the extraction read pattern.
+
+Run once after `extract_hdf5.py` has built the frames file. Every frame of the source file is its own dataset, so
+reading a video still walks 108 datasets through the virtual mapping. The repacked file holds one contiguous
+`Original/<video>/frames` dataset per video. `extract_hdf5.py` reads whole clips, so by default a clip is a single
+chunk and a video read is one chunk read and decompress. `--benchmark` compares that against about 1 MiB chunks,
+which suit random single frame access better. Chunks are compressed with Blosc2 LZ4 and byte shuffle when
+`hdf5plugin` is installed, otherwise with LZF, which is built into h5py. Both decompress faster than the disk
+delivers raw frames. `extract_hdf5.py` reads from the repacked file whenever it exists and has the current
+frame order.
+"""
+
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from extract_hdf5 import FRAMES_PATH, NUM_FRAMES, NUM_VIDEOS, REPACKED_PATH
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def frames_per_chunk(num_frames: int, frame_shape: tuple, dtype: np.dtype) -> int:
+    """Number of whole frames that fit in `CHUNK_BYTES`, at least one."""
+    frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+    return min(num_frames, max(1, CHUNK_BYTES // frame_bytes))
+
+
+def compression_options() -> dict:
+    """`create_dataset` filter options, Blosc2 LZ4 with byte shuffle if available, else LZF."""
+    if hdf5plugin is None:
+        return dict(compression="lzf")
+    return dict(
+        **hdf5plugin.Blosc2(cname="lz4", clevel=5, filters=hdf5plugin.Blosc2.SHUFFLE)
+    )
+
+
+def repack(
+    frames_path: str,
+    repacked_path: str,
+    chunk_frames: int = NUM_FRAMES,
+    num_videos: int = NUM_VIDEOS,
+) -> None:
+    """Copies the first `num_videos` videos with chunks of `chunk_frames` frames, `None` for about 1 MiB chunks."""
+    # Written under a temporary name, the extractor never picks up a partially repacked file.
+    tmp_path = f"{repacked_path}.tmp"
+    with h5py.File(frames_path, "r") as src, h5py.File(tmp_path, "w") as out:
+        for video_idx in range(num_videos):
+            name = f"Original/{video_idx:03}/frames"
+            frames = src[name][()]
+            video_chunk_frames = (
+                min(chunk_frames, frames.shape[0])
+                if chunk_frames is not None
+                else frames_per_chunk(frames.shape[0], frames.shape[1:], frames.dtype)
+            )
+            out.create_dataset(
+                name,
+                data=frames,
+                chunks=(video_chunk_frames, *frames.shape[1:]),
+                **compression_options(),
+            )
+        # Frames keep the order of the source file, a stale source yields a stale repack.
+        if "frame_order" in src.attrs:
+            out.attrs["frame_order"] = src.attrs["frame_order"]
+    os.replace(tmp_path, repacked_path)
+
+
+def drop_page_cache(path: str) -> None:
+    """Flushes `path` and asks the OS to evict its pages, so the next read comes from disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        # Linux only, elsewhere the timings are warm cache numbers.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def benchmark_chunking(frames_path: str, num_videos: int = 20) -> None:
+    """Repacks the first `num_videos` videos with a clip per chunk and with about 1 MiB chunks, then times whole
+    clip reads, what `extract_hdf5.py` does, and random single frame reads on each.
+
+    Both layouts are written before anything is timed and every timed pass starts from a fresh file handle with
+    the file evicted from the OS page cache, so the numbers are cold cache reads. Pass the winning layout to
+    `repack`.
+    """
+    rng = np.random.default_rng(0)
+    layouts = (("clip per chunk", NUM_FRAMES), ("~1 MiB chunks", None))
+    bench_paths = [f"{REPACKED_PATH}.bench{layout_idx}" for layout_idx in range(len(layouts))]
+    for (_, chunk_frames), bench_path in zip(layouts, bench_paths):
+        repack(frames_path, bench_path, chunk_frames=chunk_frames, num_videos=num_videos)
+
+    def time_reads(bench_path: str, read) -> float:
+        drop_page_cache(bench_path)
+        with h5py.File(bench_path, "r") as hf:
+            videos = [hf[f"Original/{video_idx:03}/frames"] for video_idx in range(num_videos)]
+            start = time.perf_counter()
+            for video in videos:
+                read(video)
+            return time.perf_counter() - start
+
+    for (label, _), bench_path in zip(layouts, bench_paths):
+        clip_seconds = time_reads(bench_path, lambda video: video[()])
+        frame_seconds = time_reads(bench_path, lambda video: video[rng.integers(video.shape[0])])
+        os.remove(bench_path)
+
+        print(
+            f"{label}: {clip_seconds / num_videos * 1e3:.2f} ms per clip, "
+            f"{frame_seconds / num_videos * 1e3:.2f} ms per random frame"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare chunk layouts on a few videos instead of repacking.",
+    )
+    parser.add_argument(
+        "--chunk-frames",
+        type=int,
+        default=NUM_FRAMES,
+        help="Frames per chunk, 0 for about 1 MiB chunks. Defaults to a whole clip per chunk.",
+    )
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_chunking(frames_path=FRAMES_PATH)
+    else:
+        repack(
+            frames_path=FRAMES_PATH,
+            repacked_path=REPACKED_PATH,
+            chunk_frames=args.chunk_frames or None,
+        )